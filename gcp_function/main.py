@@ -1,9 +1,20 @@
+from __future__ import annotations
+
 import os
+from typing import TYPE_CHECKING
+
 import requests
-import pandas as pd
-from google.cloud import bigquery
+import orjson
 import functions_framework
 
+# pandas, pyarrow and BigQuery are imported inside the functions that use them, so a cold start
+# that finds no new events never pays for importing them.
+if TYPE_CHECKING:
+    from typing import Callable
+
+    import pandas as pd
+    from google.cloud import bigquery
+
 # --- Configuration ---
 # These values are pulled from the Cloud Function's environment variables
 PROJECT_ID = os.environ.get("GCP_PROJECT")
@@ -11,90 +22,191 @@ DATASET_ID = os.environ.get("BIGQUERY_DATASET")
 STAGING_TABLE_ID = "staging_raw_events"
 API_URL = "https://bannerevents.archonphserver.com/api.php"
 
+# Arrow types of the numeric API fields, as loaded into the staging table; every other field is a string.
+# Used for fields that are null in every record of a batch, which Arrow would otherwise type as null.
+NUMERIC_EVENT_FIELD_TYPES = {'id': 'int64', 'sentiment': 'float64', 'amount': 'float64'}
+
+# Matches the trailing size suffix of a banner_id, e.g. '300x600' in 'unity_finance_300x600'.
+BANNER_SIZE_PATTERN = r'\d+x\d+'
+
+# --- Mappings for Standardization ---
+# Converted to Series once, on first use, by get_standardization_mappings().
+# Keys are lowercase to ensure case-insensitive matching. Values are the desired canonical form.
+COUNTRY_MAPPING = {
+    # Common abbreviations and variations
+    'usa': 'United States',
+    'u.s.a.': 'United States',
+    'united states of america': 'United States',
+    'uk': 'United Kingdom',
+    'great britain': 'United Kingdom',
+    'england': 'United Kingdom', # Note: A simplification for this context
+    
+    # Different languages or common misspellings
+    'türkiye': 'Turkey',
+    'deutschland': 'Germany',
+    'españa': 'Spain',
+    'brasil': 'Brazil',
+    
+    # Normalizing casing/spacing
+    'the netherlands': 'Netherlands',
+    'south korea': 'South Korea',
+    'new zealand': 'New Zealand',
+}
+
+# Keys are lowercase and have spaces removed to match the transformation logic below.
+CITY_MAPPING = {
+    'newyork': 'New York',
+    'nyc': 'New York',
+    'st petersburg': 'Saint Petersburg', # This becomes 'stpetersburg' after normalization
+    'stpetersburg': 'Saint Petersburg',
+    'frankfurt am main': 'Frankfurt', # This becomes 'frankfurtammain'
+    'frankfurtammain': 'Frankfurt',
+    'sf': 'San Francisco',
+    'sanfran': 'San Francisco',
+    'la': 'Los Angeles',
+    'losangeles': 'Los Angeles',
+    'sao paulo': 'São Paulo', # This becomes 'saopaulo'
+    'saopaulo': 'São Paulo'
+}
+
+# Passed to str.translate to delete every space in a single pass.
+SPACE_DELETION_TABLE = {ord(' '): None}
+
+UNIT_MAPPING = {'dwell': 'seconds', 'scroll': 'pixels'}
+
+_standardization_mappings = None
+
 # --- Initialize BigQuery Client ---
-# Initialized globally to reuse the connection across function invocations for efficiency
-bq_client = bigquery.Client()
+# Created on first use, then kept globally to reuse the connection across function invocations for efficiency
+_bq_client = None
+
+
+def get_bq_client() -> bigquery.Client:
+    """Returns the shared BigQuery client, creating it on the first call."""
+    global _bq_client
+    if _bq_client is None:
+        from google.cloud import bigquery
+        _bq_client = bigquery.Client()
+    return _bq_client
+
+
+def get_standardization_mappings() -> tuple[pd.Series, pd.Series, pd.Series]:
+    """
+    Returns the country, city and unit mappings as Series, building them on the first call.
+    Each .map() call is then a direct index lookup.
+    """
+    global _standardization_mappings
+    if _standardization_mappings is None:
+        import pandas as pd
+        _standardization_mappings = (
+            pd.Series(COUNTRY_MAPPING), pd.Series(CITY_MAPPING), pd.Series(UNIT_MAPPING)
+        )
+    return _standardization_mappings
+
+
+def events_to_dataframe(events: list) -> pd.DataFrame:
+    """
+    Builds an Arrow-backed DataFrame from the API's list of event records.
+    Arrow infers typed columns in C++, so string operations downstream run over Arrow buffers
+    instead of per-row Python objects.
+    """
+    import pandas as pd
+    import pyarrow as pa
+
+    try:
+        # Converting via a struct array keeps every field seen in any record, not just the first one.
+        table = pa.Table.from_struct_array(pa.array(events))
+    except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+        # A field with mixed value types has no single Arrow type; let pandas infer object columns instead.
+        print(f"Warning: Falling back to pandas type inference for API events: {e}")
+        return pd.DataFrame(events)
+
+    # Null-typed columns break categorical and .str operations downstream, so give them their real type.
+    schema = pa.schema([
+        pa.field(field.name, pa.type_for_alias(NUMERIC_EVENT_FIELD_TYPES.get(field.name, 'string')))
+        if pa.types.is_null(field.type) else field
+        for field in table.schema
+    ])
+    return table.cast(schema).to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def standardize_values(
+    values: pd.Series, mapping: pd.Series, normalize: Callable[[pd.Series], pd.Series]
+) -> pd.Series:
+    """
+    Maps a string column onto canonical values using its normalized form as the lookup key.
+    Unmapped items fall back to the original value (but properly title-cased).
+
+    The column is converted to a categorical so that normalization and lookup run once per
+    distinct value rather than once per row.
+    """
+    import pandas as pd
+
+    categorical = values.astype('category')
+    categories = pd.Series(categorical.cat.categories, dtype=object)
+    canonical = normalize(categories).map(mapping).fillna(categories.str.title())
+
+    # Missing values have code -1, which has no label in `canonical` and so stays NaN.
+    return pd.Series(canonical.reindex(categorical.cat.codes).to_numpy(), index=values.index)
+
 
 def preprocess_dataframe(df: pd.DataFrame) -> pd.DataFrame:
     """
     Performs all row-level transformations, cleaning, and feature engineering on the DataFrame.
     This prepares the data for loading into the pre-processed staging table.
     """
+    import pandas as pd
+
     print("Starting pre-processing on the DataFrame...")
+    country_mapping, city_mapping, unit_mapping = get_standardization_mappings()
 
-    # --- Mapping Dictionaries for Standardization ---
-    # Keys are lowercase to ensure case-insensitive matching. Values are the desired canonical form.
-    COUNTRY_MAPPING = {
-        # Common abbreviations and variations
-        'usa': 'United States',
-        'u.s.a.': 'United States',
-        'united states of america': 'United States',
-        'uk': 'United Kingdom',
-        'great britain': 'United Kingdom',
-        'england': 'United Kingdom', # Note: A simplification for this context
-        
-        # Different languages or common misspellings
-        'türkiye': 'Turkey',
-        'deutschland': 'Germany',
-        'españa': 'Spain',
-        'brasil': 'Brazil',
-        
-        # Normalizing casing/spacing
-        'the netherlands': 'Netherlands',
-        'south korea': 'South Korea',
-        'new zealand': 'New Zealand',
-    }
-    
-    # Keys are lowercase and have spaces removed to match the transformation logic below.
-    CITY_MAPPING = {
-        'newyork': 'New York',
-        'nyc': 'New York',
-        'st petersburg': 'Saint Petersburg', # This becomes 'stpetersburg' after normalization
-        'stpetersburg': 'Saint Petersburg',
-        'frankfurt am main': 'Frankfurt', # This becomes 'frankfurtammain'
-        'frankfurtammain': 'Frankfurt',
-        'sf': 'San Francisco',
-        'sanfran': 'San Francisco',
-        'la': 'Los Angeles',
-        'losangeles': 'Los Angeles',
-        'sao paulo': 'São Paulo', # This becomes 'saopaulo'
-        'saopaulo': 'São Paulo'
-    }
-    
-    
     # 1. Handle Amount -> unit_name, unit_value
-    def get_unit(event):
-        if event == 'dwell': return 'seconds'
-        if event == 'scroll': return 'pixels'
-        return 'count'
-    
-    df['unit_name'] = df['event'].apply(get_unit)
-    df['unit_value'] = df['amount']
+    # A vectorized map keeps this in C; any event without a specific unit is a 'count'.
+    df['unit_name'] = df['event'].map(unit_mapping).fillna('count')
+    # unit_value is produced directly from amount by the type coercion in step 5, avoiding an extra column copy.
     
     # 2. Split Banner ID -> banner_name, banner_size
-    # Uses pandas' vectorized string operations for performance and handling of nulls.
-    df['banner_size'] = df['banner_id'].str.extract(r'(\d+x\d+)', expand=False)
-    df['banner_name'] = df['banner_id'].str.replace(r'_(\d+x\d+)$', '', regex=True)
+    # A single split on the last '_' yields both parts; the tail is only a size if it looks like 'WxH'.
+    if df['banner_id'].notna().any():
+        banner_parts = df['banner_id'].str.rpartition('_')
+        has_size = banner_parts[1].eq('_') & banner_parts[2].str.fullmatch(BANNER_SIZE_PATTERN, na=False)
+        df['banner_size'] = banner_parts[2].where(has_size)
+        df['banner_name'] = banner_parts[0].where(has_size, df['banner_id'])
+    else:
+        # Nothing to split, and rpartition would return a single column for an all-null banner_id.
+        df['banner_size'] = None
+        df['banner_name'] = df['banner_id']
 
     # 3. Split Category -> category_l1, l2, l3
-    cat_splits = df['category'].str.strip('/').str.split('/', expand=True)
+    # An all-null category has nothing to split, and expanding it fails on Arrow-backed strings.
+    if df['category'].notna().any():
+        cat_splits = df['category'].str.strip('/').str.split('/', expand=True)
+    else:
+        cat_splits = pd.DataFrame(index=df.index)
     df['category_l1'] = cat_splits.get(0)
     df['category_l2'] = cat_splits.get(1)
     df['category_l3'] = cat_splits.get(2)
     
     # 4. Standardize Location Data
-    # Create temporary lowercase columns for robust mapping.
-    df['country_lower'] = df['country'].str.lower().str.strip().fillna('')
-    # Map values, and for any unmapped items, fall back to the original value (but properly title-cased).
-    df['country'] = df['country_lower'].map(COUNTRY_MAPPING).fillna(df['country'].str.title())
-
-    df['city_lower'] = df['city'].str.lower().str.replace(" ", "").str.strip().fillna('')
-    df['city'] = df['city_lower'].map(CITY_MAPPING).fillna(df['city'].str.title())
+    # Normalization is applied to the distinct values only, then broadcast back to every row.
+    df['country'] = standardize_values(
+        df['country'], country_mapping, lambda s: s.str.lower().str.strip()
+    )
+    df['city'] = standardize_values(
+        df['city'], city_mapping, lambda s: s.str.casefold().str.translate(SPACE_DELETION_TABLE).str.strip()
+    )
     
     # 5. Coerce data types to align with BigQuery schema and handle errors
-    df['id'] = pd.to_numeric(df['id'], errors='coerce').astype('Int64')
-    df['sentiment'] = pd.to_numeric(df['sentiment'], errors='coerce').astype('float64')
-    df['unit_value'] = pd.to_numeric(df['unit_value'], errors='coerce').astype('float64')
+    # Columns that already parsed as numbers are cast directly; only the rest need a coercing parse.
+    for column, source, dtype in [
+        ('id', 'id', 'Int64'),
+        ('sentiment', 'sentiment', 'float64'),
+        ('unit_value', 'amount', 'float64'),
+    ]:
+        values = df[source]
+        if not pd.api.types.is_numeric_dtype(values):
+            values = pd.to_numeric(values, errors='coerce')
+        df[column] = values.astype(dtype)
 
     # 6. Define the final schema for the staging table to ensure column order and presence
     final_columns = [
@@ -113,21 +225,30 @@ def preprocess_dataframe(df: pd.DataFrame) -> pd.DataFrame:
 
 def run_transformation_sql():
     """
-    Executes a series of idempotent SQL queries to process data from the
-    staging table into the final dimension and fact tables.
+    Executes a series of idempotent SQL queries, submitted together as a single
+    BigQuery script, to process data from the staging table into the final
+    dimension and fact tables.
 
     This function assumes that the `dim_time` table has already been
     pre-populated with all necessary dates.
     """
     
     sql_queries = [
-        # 1. Populate dim_user
+        # 1. Deduplicate the staging table once into a script-scoped temp table.
+        # Every statement below reads from it, instead of each re-scanning the staging table.
+        f"""
+        CREATE TEMP TABLE staging_dedup AS
+        SELECT DISTINCT *
+        FROM `{PROJECT_ID}.{DATASET_ID}.{STAGING_TABLE_ID}`;
+        """,
+        
+        # 2. Populate dim_user
         # Merges new users based on their unique unity_user_id.
         f"""
         MERGE `{PROJECT_ID}.{DATASET_ID}.dim_user` T
         USING (
             SELECT DISTINCT unity_user_id 
-            FROM `{PROJECT_ID}.{DATASET_ID}.{STAGING_TABLE_ID}` 
+            FROM staging_dedup 
             WHERE unity_user_id IS NOT NULL
         ) S
         ON T.user_id = S.unity_user_id
@@ -136,13 +257,13 @@ def run_transformation_sql():
           VALUES(FARM_FINGERPRINT(S.unity_user_id), S.unity_user_id);
         """,
         
-        # 2. Populate dim_location
+        # 3. Populate dim_location
         # Merges new locations based on their unique IP address.
         f"""
         MERGE `{PROJECT_ID}.{DATASET_ID}.dim_location` T
         USING (
             SELECT DISTINCT ip, country, city 
-            FROM `{PROJECT_ID}.{DATASET_ID}.{STAGING_TABLE_ID}` 
+            FROM staging_dedup 
             WHERE ip IS NOT NULL
         ) S
         ON T.ip_address = S.ip
@@ -151,13 +272,13 @@ def run_transformation_sql():
           VALUES(FARM_FINGERPRINT(S.ip), S.ip, S.country, S.city);
         """,
         
-        # 3. Populate dim_banner
+        # 4. Populate dim_banner
         # Merges new banner variations based on the composite key of name and size.
         f"""
         MERGE `{PROJECT_ID}.{DATASET_ID}.dim_banner` T
         USING (
             SELECT DISTINCT banner_name, banner_size
-            FROM `{PROJECT_ID}.{DATASET_ID}.{STAGING_TABLE_ID}`
+            FROM staging_dedup
             WHERE banner_name IS NOT NULL
         ) S
         ON T.banner_name = S.banner_name 
@@ -171,13 +292,13 @@ def run_transformation_sql():
           );
         """,
         
-        # 4. Populate dim_content
+        # 5. Populate dim_content
         # Merges new content pages based on their unique URL.
         f"""
         MERGE `{PROJECT_ID}.{DATASET_ID}.dim_content` T
         USING (
             SELECT DISTINCT url, sentiment, entities, category_l1, category_l2, category_l3
-            FROM `{PROJECT_ID}.{DATASET_ID}.{STAGING_TABLE_ID}`
+            FROM staging_dedup
             WHERE url IS NOT NULL
         ) S
         ON T.url = S.url
@@ -194,57 +315,98 @@ def run_transformation_sql():
           );
         """,
         
-        # 5. Populate the final fact_events table
-        # This is an INSERT statement that looks up all foreign keys from the dimensions.
+        # 6. Populate the final fact_events table
+        # Merges new events, looking up all foreign keys from the dimensions.
+        # Matching on event_id ensures we only insert events that are not already in the fact table,
+        # making the pipeline idempotent, without the full NOT IN subquery over fact_events.
         f"""
-        INSERT INTO `{PROJECT_ID}.{DATASET_ID}.fact_events` 
-          (event_id, event_timestamp, time_sk, user_sk, content_sk, banner_sk, location_sk, event_name, element_id, unit_name, unit_value)
-        SELECT
-          s.id AS event_id,
-          
-          -- The full timestamp is still valuable for precise analysis and partitioning.
-          PARSE_TIMESTAMP('%Y-%m-%d %H:%M:%E*S', s.issue_date) AS event_timestamp,
-          
-          -- Foreign Key Lookups --
-          t.time_sk,
-          u.user_sk,
-          c.content_sk,
-          b.banner_sk,
-          l.location_sk,
-          
-          -- Measures and Event Details --
-          s.event AS event_name,
-          s.element_id,
-          s.unit_name,
-          s.unit_value
-        FROM `{PROJECT_ID}.{DATASET_ID}.{STAGING_TABLE_ID}` s
-
-        -- Join to pre-populated dim_time by calculating the YYYYMMDD key from the event's issue_date.
-        LEFT JOIN `{PROJECT_ID}.{DATASET_ID}.dim_time` t 
-            ON t.time_sk = CAST(FORMAT_DATE('%Y%m%d', DATE(PARSE_TIMESTAMP('%Y-%m-%d %H:%M:%E*S', s.issue_date))) AS INT64)
-            
-        -- Join other dimensions to get their surrogate keys
-        LEFT JOIN `{PROJECT_ID}.{DATASET_ID}.dim_user` u ON u.user_id = s.unity_user_id
-        LEFT JOIN `{PROJECT_ID}.{DATASET_ID}.dim_location` l ON l.ip_address = s.ip
-        LEFT JOIN `{PROJECT_ID}.{DATASET_ID}.dim_content` c ON c.url = s.url
-        LEFT JOIN `{PROJECT_ID}.{DATASET_ID}.dim_banner` b ON 
-            b.banner_name = s.banner_name 
-            AND COALESCE(b.banner_size, '') = COALESCE(s.banner_size, '') 
-            
-        -- This WHERE clause ensures we only insert events that are not already in the fact table, making the pipeline idempotent.
-        WHERE s.id IS NOT NULL 
-          AND s.id NOT IN (SELECT event_id FROM `{PROJECT_ID}.{DATASET_ID}.fact_events`);
+        MERGE `{PROJECT_ID}.{DATASET_ID}.fact_events` T
+        USING (
+            -- Parse each event's timestamp and derive its date once per row; the timestamp is loaded as a column
+            -- and the date builds the dim_time key. The date needs its own CTE to reference event_ts.
+            WITH parsed AS (
+                SELECT *, PARSE_TIMESTAMP('%Y-%m-%d %H:%M:%E*S', issue_date) AS event_ts
+                FROM staging_dedup
+                WHERE id IS NOT NULL
+            ),
+            staged AS (
+                SELECT *, DATE(event_ts) AS event_date
+                FROM parsed
+            )
+            SELECT
+              s.id AS event_id,
+              
+              -- The full timestamp is still valuable for precise analysis and partitioning.
+              s.event_ts AS event_timestamp,
+              
+              -- Foreign Key Lookups --
+              t.time_sk,
+              u.user_sk,
+              c.content_sk,
+              b.banner_sk,
+              l.location_sk,
+              
+              -- Measures and Event Details --
+              s.event AS event_name,
+              s.element_id,
+              s.unit_name,
+              s.unit_value
+            FROM staged s
+
+            -- Join to pre-populated dim_time by calculating the YYYYMMDD key from the event's issue_date.
+            -- Integer arithmetic on the date parts avoids formatting to a string and parsing it back.
+            LEFT JOIN `{PROJECT_ID}.{DATASET_ID}.dim_time` t 
+                ON t.time_sk = EXTRACT(YEAR FROM s.event_date) * 10000
+                             + EXTRACT(MONTH FROM s.event_date) * 100
+                             + EXTRACT(DAY FROM s.event_date)
+                
+            -- Join other dimensions to get their surrogate keys
+            LEFT JOIN `{PROJECT_ID}.{DATASET_ID}.dim_user` u ON u.user_id = s.unity_user_id
+            LEFT JOIN `{PROJECT_ID}.{DATASET_ID}.dim_location` l ON l.ip_address = s.ip
+            LEFT JOIN `{PROJECT_ID}.{DATASET_ID}.dim_content` c ON c.url = s.url
+            LEFT JOIN `{PROJECT_ID}.{DATASET_ID}.dim_banner` b ON 
+                b.banner_name = s.banner_name 
+                AND COALESCE(b.banner_size, '') = COALESCE(s.banner_size, '') 
+        ) S
+        ON T.event_id = S.event_id
+        WHEN NOT MATCHED THEN
+          INSERT (event_id, event_timestamp, time_sk, user_sk, content_sk, banner_sk, location_sk, event_name, element_id, unit_name, unit_value)
+          VALUES(
+            S.event_id,
+            S.event_timestamp,
+            S.time_sk,
+            S.user_sk,
+            S.content_sk,
+            S.banner_sk,
+            S.location_sk,
+            S.event_name,
+            S.element_id,
+            S.unit_name,
+            S.unit_value
+          );
         """
     ]
 
-    for i, query in enumerate(sql_queries):
-        # We start from 1 for better logging readability
-        print(f"Executing transform query {i + 1}/{len(sql_queries)}...")
-        job = bq_client.query(query)
-        job.result()  # Wait for the query to complete
-        
+    # Submit all statements as one multi-statement script: BigQuery still runs them in order,
+    # but we pay for a single job round-trip instead of one per statement.
+    script = "BEGIN\n" + "\n".join(sql_queries) + "\nEND;"
+
+    print(f"Executing {len(sql_queries)} transform queries as a single script job...")
+    bq_client = get_bq_client()
+    job = bq_client.query(script)
+    job.result()  # Wait for the whole script to complete
+    print("Transform script completed.")
+
+    # Each statement runs as a child job; they are listed newest first, so reverse for readability.
+    # The script has already committed by now, so a failure here must not fail the run.
+    try:
+        child_jobs = list(bq_client.list_jobs(parent_job=job))[::-1]
+    except Exception as e:
+        print(f"Warning: Could not fetch per-statement row counts: {e}")
+        return
+    for i, child_job in enumerate(child_jobs):
         # DML statements like MERGE and INSERT have a num_dml_affected_rows attribute
-        rows_affected = job.num_dml_affected_rows if job.num_dml_affected_rows is not None else 0
+        rows_affected = getattr(child_job, "num_dml_affected_rows", None) or 0
         print(f"Query {i + 1} completed. Rows affected: {rows_affected}")
 
 @functions_framework.http
@@ -259,21 +421,28 @@ def process_banner_events(request):
     try:
         response = requests.get(API_URL, timeout=45)
         response.raise_for_status()
-        events_json = response.json()
+        events_json = orjson.loads(response.content)
         if not events_json:
             print("API returned no new events. Exiting.")
             return "Success: No new events to process.", 200
         print(f"Successfully fetched {len(events_json)} events from the API.")
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
         print(f"Error: Failed to fetch data from API: {e}")
         return f"API Fetch Error: {e}", 500
 
     # 2. --- PRE-PROCESS & LOAD ---
-    df_raw = pd.DataFrame(events_json)
+    from google.cloud import bigquery
+
+    df_raw = events_to_dataframe(events_json)
     df_processed = preprocess_dataframe(df_raw)
     
+    bq_client = get_bq_client()
     table_ref = bq_client.dataset(DATASET_ID).table(STAGING_TABLE_ID)
-    job_config = bigquery.LoadJobConfig(write_disposition="WRITE_TRUNCATE")
+    # Pin the Parquet (Arrow) load format explicitly rather than relying on the client default.
+    job_config = bigquery.LoadJobConfig(
+        source_format=bigquery.SourceFormat.PARQUET,
+        write_disposition="WRITE_TRUNCATE",
+    )
 
     try:
         print(f"Loading {len(df_processed)} pre-processed rows into staging table...")